@@ -1,23 +1,38 @@
 """Forward Telegram messages to WhatsApp with local media hosting."""
 
 import asyncio
+import io
 import logging
+import mimetypes
 import os
-from datetime import datetime, time, timedelta
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import math
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Awaitable, Callable, List, Optional, Tuple
 from urllib.parse import urlparse
 
 from aiohttp import web
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from PIL import Image
-from telethon import TelegramClient, events, types
+from telethon import TelegramClient, types
 from telethon.sessions import StringSession
-from twilio.base.exceptions import TwilioRestException
-from twilio.rest import Client as TwilioClient
 
-from util import split_csv, parse_ids, send_whatsapp, sender_matches
+from util import (
+    TWILIO_HTTPX,
+    make_handlers,
+    parse_ids,
+    run_cpu,
+    run_io,
+    send_whatsapp,
+    split_csv,
+    start_cpu_pool,
+    start_send_workers,
+    stop_cpu_pool,
+)
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s  %(levelname)s  %(message)s")
@@ -69,65 +84,217 @@ MAX_BODY = 1024
 
 logging.info("WhatsApp from: %r, targets: %r", WA_FROM, WA_TARGETS)
 
-twilio = TwilioClient(TWILIO_SID, TWILIO_TOKEN)
-
 IMG_DIR = Path("Img")
 IMG_DIR.mkdir(exist_ok=True)
+COLLAGE_CELL = 720
+# Nightly cleanup time as seconds since midnight (23:59).
+CLEANUP_AT = 23 * 3600 + 59 * 60
+
+# Small recently saved files kept in memory so repeated Twilio fetches don't
+# hit the disk. Keyed by file name, least recently used entries evicted first.
+MEDIA_CACHE: "OrderedDict[str, bytes]" = OrderedDict()
+MEDIA_CACHE_SIZE = 64
+MEDIA_CACHE_MAX_BYTES = 512 * 1024
+CACHE_HEADERS = {"Cache-Control": "public, max-age=86400"}
+# Media already saved for a message, keyed by (chat_id, msg.id, file id), so
+# redelivered messages reuse the file instead of downloading it again.
+SAVED_MEDIA: "TTLCache[tuple, Tuple[Path, str]]" = TTLCache(maxsize=512, ttl=3600)
+# Concurrent downloads per album.
+ALBUM_DOWNLOADS = 4
+# Media up to this size is downloaded into memory and written to disk once.
+IN_MEMORY_MAX_BYTES = 10 * 1024 * 1024
 
 
 TG_GROUP_IDS = parse_ids(os.getenv("TG_GROUP_IDS"))
-BOT_IDS = set(parse_ids(os.getenv("BOT_IDS", "")))
+BOT_IDS = frozenset(parse_ids(os.getenv("BOT_IDS", "")))
 
 
-async def start_media_server() -> web.AppRunner:
+def _read_small(path: Path) -> Optional[bytes]:
+    """Return the file's bytes if it is small enough for ``MEDIA_CACHE``."""
+    if path.stat().st_size > MEDIA_CACHE_MAX_BYTES:
+        return None
+    return path.read_bytes()
+
+
+def _cache_media(name: str, data: bytes) -> None:
+    MEDIA_CACHE[name] = data
+    while len(MEDIA_CACHE) > MEDIA_CACHE_SIZE:
+        MEDIA_CACHE.popitem(last=False)
+
+
+def make_media_app() -> web.Application:
+    """Build the aiohttp app that serves files from ``IMG_DIR``."""
+
     async def serve_media(request: web.Request) -> web.StreamResponse:
         filename = request.match_info.get("filename")
+        # aiohttp unquotes the segment after routing, so "..%2F" arrives as
+        # "../"; only plain file names inside IMG_DIR may be served.
+        if not filename or filename in (".", "..") or Path(filename).name != filename:
+            logging.error("Rejected media path: %r", filename)
+            raise web.HTTPNotFound()
+        cached = MEDIA_CACHE.pop(filename, None)
+        if cached is not None:
+            MEDIA_CACHE[filename] = cached
+            logging.info("Serving %s from memory", filename)
+            content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            return web.Response(
+                body=cached, content_type=content_type, headers=CACHE_HEADERS
+            )
         path = IMG_DIR / filename
         if not path.exists():
             logging.error("Requested file missing: %s", path)
             raise web.HTTPNotFound()
         logging.info("Serving %s", path)
-        return web.FileResponse(path)
+        return web.FileResponse(path, headers=CACHE_HEADERS)
 
     app = web.Application()
     app.router.add_get(f"{MEDIA_ROUTE}/{{filename}}", serve_media)
-    runner = web.AppRunner(app)
+    return app
+
+
+async def start_media_server() -> web.AppRunner:
+    runner = web.AppRunner(make_media_app())
     await runner.setup()
-    site = web.TCPSite(runner, port=MEDIA_PORT)
+    site = web.TCPSite(runner, port=MEDIA_PORT, backlog=128)
     await site.start()
     logging.info("Media server running at %s%s", MEDIA_BASE_URL.rstrip("/"), MEDIA_ROUTE)
     return runner
 
 
-async def save_media(msg: types.Message) -> Optional[Tuple[Path, str]]:
-    """Download media and return the local path and public URL."""
-    if not getattr(msg, "photo", None) and not getattr(msg, "document", None):
-        return None
+def _convert_webp(path: Path, jpg_path: Path) -> None:
+    """Re-encode a WEBP file as JPEG and remove the original.
+
+    ``jpg_path`` may equal ``path`` for WEBP data saved under ``.jpg``, so the
+    JPEG is written to a temporary name and moved into place.
+    """
+    tmp_path = jpg_path.with_name(jpg_path.name + ".tmp")
+    with Image.open(path) as im:
+        im.convert("RGB").save(tmp_path, "JPEG")
+    os.replace(tmp_path, jpg_path)
+    if path != jpg_path:
+        path.unlink()
+
 
-    filename = f"{msg.id}_{int(msg.date.timestamp())}"
+def _is_webp(header: bytes) -> bool:
+    """Check the RIFF/WEBP magic, whatever extension Telegram reported."""
+    return header[:4] == b"RIFF" and header[8:12] == b"WEBP"
+
+
+def _read_header(path: Path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(12)
+
+
+def _webp_to_jpeg(data: bytes, jpg_path: Path) -> bytes:
+    """Write WEBP ``data`` to ``jpg_path`` as JPEG and return the JPEG bytes."""
+    out = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as im:
+        im.convert("RGB").save(out, "JPEG")
+    jpeg = out.getvalue()
+    jpg_path.write_bytes(jpeg)
+    return jpeg
+
+
+async def _download_to_disk(msg: types.Message, filename: str) -> Optional[Path]:
+    """Download large media straight to ``IMG_DIR``."""
     path_str = await msg.download_media(file=IMG_DIR / filename)
     if not path_str:
-        logging.error("Failed to download media for message %s", msg.id)
         return None
-
     logging.info("Downloaded media to %s", path_str)
 
     path = Path(path_str)
-    if path.suffix.lower() == ".webp":
+    header = await run_io(_read_header, path)
+    if _is_webp(header) or path.suffix.lower() == ".webp":
         jpg_path = path.with_suffix(".jpg")
         try:
-            Image.open(path).convert("RGB").save(jpg_path, "JPEG")
-            path.unlink()
+            await run_cpu(_convert_webp, path, jpg_path)
             logging.info("Converted %s to %s", path, jpg_path)
             path = jpg_path
         except Exception as e:
             logging.error("Failed to convert %s: %s", path, e)
 
+    try:
+        data = await run_io(_read_small, path)
+    except OSError as e:
+        logging.error("Failed to cache %s: %s", path, e)
+    else:
+        if data is not None:
+            _cache_media(path.name, data)
+    return path
+
+
+async def _download_to_memory(msg: types.Message, filename: str) -> Optional[Path]:
+    """Download media into memory, converting WEBP before the only disk write."""
+    buf = io.BytesIO()
+    await msg.download_media(file=buf)
+    data = buf.getvalue()
+    if not data:
+        return None
+
+    path = IMG_DIR / f"{filename}{getattr(msg.file, 'ext', None) or ''}"
+    if _is_webp(data[:12]) or path.suffix.lower() == ".webp":
+        jpg_path = path.with_suffix(".jpg")
+        try:
+            data = await run_cpu(_webp_to_jpeg, data, jpg_path)
+            logging.info("Converted %s to %s", path.name, jpg_path)
+            path = jpg_path
+        except Exception as e:
+            logging.error("Failed to convert %s: %s", path.name, e)
+            await run_io(path.write_bytes, data)
+    else:
+        await run_io(path.write_bytes, data)
+    logging.info("Downloaded media to %s", path)
+
+    if len(data) <= MEDIA_CACHE_MAX_BYTES:
+        _cache_media(path.name, data)
+    return path
+
+
+async def save_media(msg: types.Message) -> Optional[Tuple[Path, str]]:
+    """Download media and return the local path and public URL."""
+    if not getattr(msg, "photo", None) and not getattr(msg, "document", None):
+        return None
+
+    key = (msg.chat_id, msg.id, getattr(getattr(msg, "file", None), "id", None))
+    saved = SAVED_MEDIA.get(key)
+    if saved:
+        if saved[0].exists():
+            logging.info("Reusing %s for message %s", saved[0], msg.id)
+            return saved
+        SAVED_MEDIA.pop(key, None)
+
+    filename = f"{msg.chat_id}_{msg.id}"
+    size = getattr(getattr(msg, "file", None), "size", None) or 0
+    if size > IN_MEMORY_MAX_BYTES:
+        path = await _download_to_disk(msg, filename)
+    else:
+        path = await _download_to_memory(msg, filename)
+    if not path:
+        logging.error("Failed to download media for message %s", msg.id)
+        return None
+
     base = MEDIA_BASE_URL.rstrip("/")
     url = f"{base}{MEDIA_ROUTE}/{path.name}"
+    SAVED_MEDIA[key] = (path, url)
     return path, url
 
 
+async def save_album(messages: List[types.Message]) -> List[Tuple[Path, str]]:
+    """Download album items concurrently, keeping order and skipping failures."""
+    sem = asyncio.Semaphore(ALBUM_DOWNLOADS)
+
+    async def _one(msg: types.Message) -> Optional[Tuple[Path, str]]:
+        async with sem:
+            try:
+                return await save_media(msg)
+            except Exception as e:
+                logging.error("Failed to save media for message %s: %s", msg.id, e)
+                return None
+
+    saved_list = await asyncio.gather(*(_one(m) for m in messages))
+    return [s for s in saved_list if s]
+
+
 async def media_to_urls(msg: types.Message) -> List[str]:
     saved = await save_media(msg)
     if not saved:
@@ -135,32 +302,62 @@ async def media_to_urls(msg: types.Message) -> List[str]:
     return [saved[1]]
 
 
+async def album_to_urls(messages: List[types.Message]) -> List[str]:
+    """Save album media and return one URL, stitching several images together."""
+    saved_list = await save_album(messages)
+    urls = [url for _, url in saved_list]
+    if len(urls) <= 1:
+        return urls
+    try:
+        collage_path = await run_cpu(make_collage, [path for path, _ in saved_list])
+    except Exception as e:
+        logging.error("Failed to build collage: %s", e)
+        return urls[:1]
+    base = MEDIA_BASE_URL.rstrip("/")
+    return [f"{base}{MEDIA_ROUTE}/{collage_path.name}"]
+
+
+async def forward(text: str, media_urls: List[str]) -> None:
+    """Send text and media URLs to every configured WhatsApp target."""
+    await send_whatsapp(
+        text,
+        media_urls,
+        account_sid=TWILIO_SID,
+        auth_token=TWILIO_TOKEN,
+        wa_from=WA_FROM,
+        wa_targets=WA_TARGETS,
+        text_tpl=TEXT_TPL,
+        img_tpl=IMG_TPL,
+        max_body=MAX_BODY,
+    )
+
+
 def make_collage(paths: List[Path]) -> Path:
-    """Create a simple two-column collage from the given image paths."""
+    """Create a simple two-column collage from the given image paths.
+
+    Each image is decoded at reduced size (``Image.draft``), scaled into a
+    fixed ``COLLAGE_CELL`` square and pasted immediately, so only one source
+    image is held in memory at a time.
+    """
     if not paths:
         raise ValueError("no images for collage")
 
-    images = []
-    for p in paths:
-        with Image.open(p) as im:
-            images.append(im.convert("RGB"))
-    cell_w = max(im.width for im in images)
-    cell_h = max(im.height for im in images)
-
+    cell = COLLAGE_CELL
     cols = 2
-    rows = math.ceil(len(images) / cols)
-    collage = Image.new("RGB", (cell_w * cols, cell_h * rows), color="white")
+    rows = math.ceil(len(paths) / cols)
+    collage = Image.new("RGB", (cell * cols, cell * rows), color="white")
 
-    for idx, im in enumerate(images):
-        im.thumbnail((cell_w, cell_h))
-        x = (idx % cols) * cell_w
-        y = (idx // cols) * cell_h
-        collage.paste(im, (x, y))
-        im.close()
+    for idx, p in enumerate(paths):
+        with Image.open(p) as im:
+            im.draft("RGB", (cell, cell))
+            im.thumbnail((cell, cell), Image.Resampling.BILINEAR)
+            x = (idx % cols) * cell
+            y = (idx // cols) * cell
+            collage.paste(im.convert("RGB"), (x, y))
 
-    name = f"collage_{int(datetime.now().timestamp())}.jpg"
+    name = f"collage_{time.time_ns():x}.jpg"
     out_path = IMG_DIR / name
-    collage.save(out_path, "JPEG")
+    collage.save(out_path, "JPEG", quality=85, optimize=False, progressive=False)
     collage.close()
     return out_path
 
@@ -187,155 +384,100 @@ async def nightly_cleanup(
         returns instead of looping and scheduling sleeps.
     """
 
-    def _cleanup() -> None:
-        cutoff = now_func() - timedelta(hours=24)
-        for path in directory.iterdir():
-            if not path.is_file():
-                continue
-            try:
-                if datetime.fromtimestamp(path.stat().st_mtime) < cutoff:
-                    path.unlink()
-                    logging.info("Deleted old file %s", path)
-            except Exception as e:
-                logging.error("Failed to delete %s: %s", path, e)
+    def _cleanup() -> List[str]:
+        cutoff_ts = (now_func() - timedelta(hours=24)).timestamp()
+        deleted: List[str] = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    if entry.stat().st_mtime < cutoff_ts:
+                        os.unlink(entry.path)
+                        deleted.append(entry.name)
+                        logging.info("Deleted old file %s", entry.path)
+                except Exception as e:
+                    logging.error("Failed to delete %s: %s", entry.path, e)
+        return deleted
+
+    def _evict(names: List[str]) -> None:
+        # Runs on the loop thread, which owns MEDIA_CACHE.
+        for name in names:
+            MEDIA_CACHE.pop(name, None)
 
     if run_once:
-        _cleanup()
+        _evict(_cleanup())
         return
 
     while True:
         now = now_func()
-        target = datetime.combine(now.date(), time(23, 59))
-        if now >= target:
-            target += timedelta(days=1)
-        await asyncio.sleep((target - now).total_seconds())
-        _cleanup()
+        seconds = now.hour * 3600 + now.minute * 60 + now.second
+        # Sleep until the next 23:59; a zero delay means we just ran.
+        delay = (CLEANUP_AT - seconds) % 86400 or 86400
+        await asyncio.sleep(delay)
+        _evict(await run_io(_cleanup))
 
 
 
 
 # ─────────────── main ──────────────────────────────────────────────────
-async def main():
+async def run(
+    album_media: Callable[[List[types.Message]], Awaitable[List[str]]],
+) -> None:
+    """Start the media server and forward Telegram messages until disconnected.
+
+    Shared by both entrypoints; ``album_media`` decides which URLs an album
+    is sent with.
+    """
+    start_cpu_pool()
     await start_media_server()
     asyncio.create_task(nightly_cleanup())
 
     session_str = TG_SESSION or ""
-    session = StringSession(session_str or None)
+    session = StringSession(session_str or None)     # None -> create an empty one
 
     client = TelegramClient(session, API_ID, API_HASH)
-    await client.start()
+    await client.start()            # If session is empty, this prompts for login/code
 
     if not session_str:
         new_string = client.session.save()
         print("\n===========  IMPORTANT  ==========")
         print("Session created. Add this string to your .env:\n")
         print(f"TG_SESSION={new_string}\n")
+        print("Subsequent runs won't require confirmation.")
         print("================================\n")
 
-    @client.on(events.NewMessage(chats=TG_GROUP_IDS))
-    async def handler(event):
-        if getattr(event.message, "grouped_id", None) is not None:
-            return
-
-        sender_ok = sender_matches(
-            await event.get_sender(), event.sender_id, BOT_IDS
-        )
-        if not sender_ok:
-            return
-
-        text = event.message.message or event.message.raw_text
-        media_urls = await media_to_urls(event.message)
-        if not text and not media_urls:
-            return
+    queue, workers = start_send_workers(forward)
+    make_handlers(
+        client,
+        chats=TG_GROUP_IDS,
+        bot_ids=BOT_IDS,
+        message_media=media_to_urls,
+        album_media=album_media,
+        queue=queue,
+    )
 
-        try:
-            await send_whatsapp(
-                text,
-                media_urls,
-                twilio_client=twilio,
-                wa_from=WA_FROM,
-                wa_targets=WA_TARGETS,
-                text_tpl=TEXT_TPL,
-                img_tpl=IMG_TPL,
-                max_body=MAX_BODY,
-                exc_cls=TwilioRestException,
-            )
-            if text:
-                logging.info("Forwarded: %s", text.splitlines()[0])
-            else:
-                logging.info("Forwarded media without text")
-        except Exception as e:
-            logging.error("Twilio error: %s", e)
-
-    @client.on(events.Album(chats=TG_GROUP_IDS))
-    async def album_handler(event):
-        sender_ok = sender_matches(
-            await event.get_sender(), event.sender_id, BOT_IDS
-        )
-        if not sender_ok:
-            return
-
-        urls: List[str] = []
-        paths: List[Path] = []
-        for msg in event.messages:
-            saved = await save_media(msg)
-            if saved:
-                path, url = saved
-                paths.append(path)
-                urls.append(url)
-
-        text = event.text or ""
-        if not text and not urls:
-            return
+    print("👂  Listening for messages …")
+    try:
+        await client.run_until_disconnected()
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        stop_cpu_pool()
+        await TWILIO_HTTPX.aclose()
 
-        try:
-            if len(urls) > 1:
-                collage_path = make_collage(paths)
-                base = MEDIA_BASE_URL.rstrip("/")
-                collage_url = f"{base}{MEDIA_ROUTE}/{collage_path.name}"
-                await send_whatsapp(
-                    text,
-                    [collage_url],
-                    twilio_client=twilio,
-                    wa_from=WA_FROM,
-                    wa_targets=WA_TARGETS,
-                    text_tpl=TEXT_TPL,
-                    img_tpl=IMG_TPL,
-                    max_body=MAX_BODY,
-                    exc_cls=TwilioRestException,
-                )
-            elif urls:
-                await send_whatsapp(
-                    text,
-                    [urls[0]],
-                    twilio_client=twilio,
-                    wa_from=WA_FROM,
-                    wa_targets=WA_TARGETS,
-                    text_tpl=TEXT_TPL,
-                    img_tpl=IMG_TPL,
-                    max_body=MAX_BODY,
-                    exc_cls=TwilioRestException,
-                )
-            else:
-                await send_whatsapp(
-                    text,
-                    None,
-                    twilio_client=twilio,
-                    wa_from=WA_FROM,
-                    wa_targets=WA_TARGETS,
-                    text_tpl=TEXT_TPL,
-                    img_tpl=IMG_TPL,
-                    max_body=MAX_BODY,
-                    exc_cls=TwilioRestException,
-                )
-            logging.info("Forwarded album with %d images", len(urls))
-        except Exception as e:
-            logging.error("Twilio error: %s", e)
 
-    print("👂  Listening for messages …")
-    await client.run_until_disconnected()
+async def main():
+    await run(album_to_urls)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if sys.platform != "win32":
+        import uvloop
+
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
 
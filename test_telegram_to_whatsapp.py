@@ -0,0 +1,65 @@
+import os
+
+import pytest
+import pytest_asyncio
+from aiohttp.test_utils import TestClient, TestServer
+from PIL import Image
+
+# telegram_to_whatsapp validates its configuration at import time.
+for _name, _value in {
+    "TG_API_ID": "1",
+    "TG_API_HASH": "hash",
+    "TWILIO_ACCOUNT_SID": "AC123",
+    "TWILIO_AUTH_TOKEN": "secret",
+    "TWILIO_WHATSAPP_FROM": "whatsapp:+100",
+    "TWILIO_WHATSAPP_TO": "whatsapp:+200",
+    "TG_GROUP_IDS": "1",
+    "MEDIA_BASE_URL": "https://example.com",
+}.items():
+    os.environ.setdefault(_name, _value)
+
+import telegram_to_whatsapp as t2w  # noqa: E402
+
+
+@pytest_asyncio.fixture
+async def media_client(tmp_path, monkeypatch):
+    img_dir = tmp_path / "Img"
+    img_dir.mkdir()
+    (img_dir / "photo.jpg").write_bytes(b"jpeg-bytes")
+    (tmp_path / "secret.env").write_text("TWILIO_AUTH_TOKEN=secret")
+    monkeypatch.setattr(t2w, "IMG_DIR", img_dir)
+    monkeypatch.setattr(t2w, "MEDIA_CACHE", type(t2w.MEDIA_CACHE)())
+
+    client = TestClient(TestServer(t2w.make_media_app()))
+    await client.start_server()
+    yield client
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_serves_files_from_img_dir(media_client):
+    resp = await media_client.get(f"{t2w.MEDIA_ROUTE}/photo.jpg")
+    assert resp.status == 200
+    assert await resp.read() == b"jpeg-bytes"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("name", ["..%2Fsecret.env", "..%2F..%2Fetc%2Fpasswd", ".."])
+async def test_rejects_paths_outside_img_dir(media_client, name):
+    resp = await media_client.get(f"{t2w.MEDIA_ROUTE}/{name}")
+    assert resp.status == 404
+
+
+@pytest.mark.parametrize("name", ["sticker.webp", "sticker.jpg"])
+def test_convert_webp_keeps_a_jpeg_at_the_target_path(tmp_path, name):
+    path = tmp_path / name
+    Image.new("RGB", (4, 4), "red").save(path, "WEBP")
+    jpg_path = path.with_suffix(".jpg")
+
+    t2w._convert_webp(path, jpg_path)
+
+    assert jpg_path.exists()
+    assert path.exists() == (path == jpg_path)
+    with Image.open(jpg_path) as im:
+        assert im.format == "JPEG"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["sticker.jpg"]
@@ -0,0 +1,96 @@
+import json
+
+import httpx
+import pytest
+
+from util import id_matches, send_whatsapp
+
+
+class FakeTwilio:
+    """Stand-in for the httpx client that records posts and replays responses."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    async def post(self, url, *, auth, data):
+        self.calls.append({"url": url, "auth": auth, "data": data})
+        status, payload = self.responses.pop(0)
+        return httpx.Response(
+            status, json=payload, request=httpx.Request("POST", url)
+        )
+
+
+SEND_KWARGS = dict(
+    account_sid="AC123",
+    auth_token="secret",
+    wa_from="whatsapp:+100",
+    wa_targets=["whatsapp:+200"],
+    text_tpl="HXtext",
+    img_tpl="HXimg",
+    max_body=5,
+)
+
+
+@pytest.mark.asyncio
+async def test_send_whatsapp_posts_message_form():
+    fake = FakeTwilio((201, {"sid": "SM1"}))
+
+    await send_whatsapp(
+        "hello world",
+        ["https://example.com/a.jpg", "https://example.com/b.jpg"],
+        http_client=fake,
+        **SEND_KWARGS,
+    )
+
+    assert len(fake.calls) == 1
+    call = fake.calls[0]
+    assert call["url"] == "https://api.twilio.com/2010-04-01/Accounts/AC123/Messages.json"
+    assert call["auth"] == ("AC123", "secret")
+    assert call["data"] == {
+        "From": "whatsapp:+100",
+        "To": "whatsapp:+200",
+        "Body": "hello world",
+        "MediaUrl": ["https://example.com/a.jpg"],
+    }
+
+
+@pytest.mark.asyncio
+async def test_send_whatsapp_retries_with_template_on_63016():
+    fake = FakeTwilio(
+        (400, {"code": 63016, "message": "outside the allowed window"}),
+        (201, {"sid": "SM2"}),
+    )
+
+    await send_whatsapp(
+        "hello world",
+        ["https://example.com/a.jpg"],
+        http_client=fake,
+        **SEND_KWARGS,
+    )
+
+    assert len(fake.calls) == 2
+    assert fake.calls[1]["data"] == {
+        "From": "whatsapp:+100",
+        "To": "whatsapp:+200",
+        "ContentSid": "HXimg",
+        "ContentVariables": json.dumps({"1": "hello"}),
+        "MediaUrl": ["https://example.com/a.jpg"],
+    }
+
+
+@pytest.mark.asyncio
+async def test_send_whatsapp_does_not_retry_other_errors():
+    fake = FakeTwilio((400, {"code": 21211, "message": "invalid To number"}))
+
+    await send_whatsapp("hi", None, http_client=fake, **SEND_KWARGS)
+
+    assert len(fake.calls) == 1
+    assert "Body" in fake.calls[0]["data"]
+
+
+def test_id_matches_only_defers_when_usernames_configured():
+    assert id_matches(42, frozenset({42, "bot"}), True) is True
+    assert id_matches(7, frozenset(), False) is True
+    assert id_matches(7, frozenset({42}), False) is False
+    assert id_matches(7, frozenset({42, "bot"}), True) is None
@@ -1,87 +1,299 @@
 import asyncio
 import json
 import logging
+import multiprocessing
+import os
 import re
-from typing import List, Sequence, Union, Optional, Type
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import (
+    AbstractSet,
+    Awaitable,
+    Callable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
-from telethon import types
+import httpx
+from telethon import events, types
 from twilio.base.exceptions import TwilioRestException
 
 
+_INT_RE = re.compile(r"-?\d+")
+
+# Blocking file I/O runs on threads; CPU-bound PIL work runs in worker
+# processes so it never holds the GIL against I/O tasks. CPU_POOL is created
+# by start_cpu_pool() from main().
+IO_POOL = ThreadPoolExecutor(max_workers=64, thread_name_prefix="io")
+CPU_POOL: Optional[ProcessPoolExecutor] = None
+
+# Twilio's REST API is called directly; one HTTP/2 connection multiplexes all
+# outgoing messages instead of a thread and request per send.
+TWILIO_API = "https://api.twilio.com/2010-04-01"
+TWILIO_HTTPX = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+    timeout=30,
+)
+
+
+def run_io(func, *args) -> asyncio.Future:
+    """Run a blocking I/O call on ``IO_POOL``."""
+    return asyncio.get_running_loop().run_in_executor(IO_POOL, func, *args)
+
+
+def start_cpu_pool() -> None:
+    """Create ``CPU_POOL``.
+
+    Workers are started by a fork server (spawn where that is unavailable)
+    rather than forked from the running, multi-threaded process.
+    """
+    global CPU_POOL
+    methods = multiprocessing.get_all_start_methods()
+    method = "forkserver" if "forkserver" in methods else "spawn"
+    CPU_POOL = ProcessPoolExecutor(
+        max_workers=max(1, (os.cpu_count() or 1) - 1),
+        mp_context=multiprocessing.get_context(method),
+    )
+
+
+def stop_cpu_pool() -> None:
+    global CPU_POOL
+    if CPU_POOL is not None:
+        CPU_POOL.shutdown(wait=False, cancel_futures=True)
+        CPU_POOL = None
+
+
+async def run_cpu(func, *args):
+    """Run a CPU-bound call on ``CPU_POOL``; arguments must be picklable.
+
+    If a worker died and broke the pool, a fresh pool is created before the
+    error is re-raised so later calls keep working.
+    """
+    pool = CPU_POOL
+    if pool is None:
+        raise RuntimeError("CPU pool is not running; call start_cpu_pool() first")
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        if pool is CPU_POOL:
+            logging.error("CPU worker pool broke; recreating it")
+            pool.shutdown(wait=False)
+            start_cpu_pool()
+        raise
+
+
+def _split_csv(raw: str) -> Iterator[str]:
+    """Yield trimmed, non-empty values from a comma-separated string."""
+    for p in raw.split(','):
+        p = p.strip()
+        if p:
+            yield p
+
+
 def split_csv(raw: str) -> List[str]:
     """Split a comma-separated string into a list of trimmed values."""
-    return [p.strip() for p in raw.split(',') if p.strip()]
+    return list(_split_csv(raw))
 
 
 def parse_ids(raw: str) -> List[Union[int, str]]:
     """Parse numeric IDs or usernames from a comma-separated string."""
     out: List[Union[int, str]] = []
-    for x in split_csv(raw):
-        out.append(int(x) if re.fullmatch(r"-?\d+", x) else x.lstrip('@'))
+    for x in _split_csv(raw):
+        out.append(int(x) if _INT_RE.fullmatch(x) else x.lstrip('@'))
     return out
 
 
 def sender_matches(
     sender: types.User,
     sender_id: int,
-    bot_ids: Sequence[Union[int, str]],
+    bot_ids: AbstractSet[Union[int, str]],
 ) -> bool:
     """Return True if the sender matches any ID or username in bot_ids."""
-    if not bot_ids:
-        return True
-    if sender_id in bot_ids:
+    if sender_id in bot_ids or not bot_ids:
         return True
     if sender and getattr(sender, 'username', None) and sender.username in bot_ids:
         return True
     return False
 
 
+def id_matches(
+    sender_id: int,
+    bot_ids: AbstractSet[Union[int, str]],
+    has_usernames: bool,
+) -> Optional[bool]:
+    """Decide from the sender ID alone; None means the username must be checked.
+
+    ``has_usernames`` says whether ``bot_ids`` holds any usernames and is
+    computed once by the caller.
+    """
+    if sender_id in bot_ids or not bot_ids:
+        return True
+    return None if has_usernames else False
+
+
+async def _sender_allowed(
+    event,
+    bot_ids: AbstractSet[Union[int, str]],
+    has_usernames: bool,
+) -> bool:
+    """Check the sender, fetching the user only when a username is needed."""
+    decision = id_matches(event.sender_id, bot_ids, has_usernames)
+    if decision is None:
+        decision = sender_matches(await event.get_sender(), event.sender_id, bot_ids)
+    return decision
+
+
+SEND_WORKERS = 4
+SEND_QUEUE_SIZE = 100
+
+
+async def _send_worker(
+    queue: "asyncio.Queue[tuple]",
+    send: Callable[[str, List[str]], Awaitable[None]],
+) -> None:
+    while True:
+        text, media_urls = await queue.get()
+        try:
+            await send(text, media_urls)
+            if text:
+                logging.info("Forwarded: %s", text.splitlines()[0])
+            else:
+                logging.info("Forwarded media without text")
+        except Exception as e:
+            logging.error("Twilio error: %s", e)
+        finally:
+            queue.task_done()
+
+
+def start_send_workers(
+    send: Callable[[str, List[str]], Awaitable[None]],
+    workers: int = SEND_WORKERS,
+) -> Tuple["asyncio.Queue[tuple]", List[asyncio.Task]]:
+    """Return a bounded ``(text, media_urls)`` queue and the tasks draining it.
+
+    Handlers only enqueue, so a slow send never holds up the next update.
+    Cancel the tasks once the queue has been joined on shutdown.
+    """
+    queue: "asyncio.Queue[tuple]" = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    tasks = [asyncio.create_task(_send_worker(queue, send)) for _ in range(workers)]
+    return queue, tasks
+
+
+def make_handlers(
+    client,
+    *,
+    chats: Sequence[Union[int, str]],
+    bot_ids: AbstractSet[Union[int, str]],
+    message_media: Callable[[types.Message], Awaitable[List[str]]],
+    album_media: Callable[[List[types.Message]], Awaitable[List[str]]],
+    queue: "asyncio.Queue[tuple]",
+) -> None:
+    """Register the message and album forwarding handlers on ``client``.
+
+    ``message_media`` and ``album_media`` turn Telegram media into public URLs;
+    the text and URLs are put on ``queue`` for the send workers.
+    """
+    has_usernames = any(isinstance(b, str) for b in bot_ids)
+
+    @client.on(events.NewMessage(chats=chats))
+    async def handler(event):
+        if getattr(event.message, "grouped_id", None) is not None:
+            return
+        if not await _sender_allowed(event, bot_ids, has_usernames):
+            return
+
+        text = event.message.message or event.message.raw_text
+        media_urls = await message_media(event.message)
+        if not text and not media_urls:
+            return
+        await queue.put((text, media_urls))
+
+    @client.on(events.Album(chats=chats))
+    async def album_handler(event):
+        if not await _sender_allowed(event, bot_ids, has_usernames):
+            return
+
+        urls = await album_media(event.messages)
+        text = event.text or ""
+        if not text and not urls:
+            return
+        logging.info("Queued album with %d items", len(event.messages))
+        await queue.put((text, urls))
+
+
+def _twilio_error(resp: httpx.Response) -> TwilioRestException:
+    """Build the SDK's exception from a failed Messages API response."""
+    try:
+        payload = resp.json()
+    except ValueError:
+        payload = {}
+    return TwilioRestException(
+        resp.status_code,
+        str(resp.request.url),
+        msg=payload.get("message", resp.text),
+        code=payload.get("code"),
+        method=resp.request.method,
+    )
+
+
 async def send_whatsapp(
     body: str,
     media_urls: Optional[Sequence[str]] = None,
     *,
-    twilio_client,
+    account_sid: str,
+    auth_token: str,
     wa_from: str,
     wa_targets: Sequence[str],
     text_tpl: Optional[str] = None,
     img_tpl: Optional[str] = None,
     max_body: int = 1024,
-    exc_cls: Type[Exception] = TwilioRestException,
+    http_client: Optional[httpx.AsyncClient] = None,
 ) -> None:
     """Send a WhatsApp message via Twilio."""
     logging.info("Sending WhatsApp: body=%r media_urls=%r", body, media_urls)
-    loop = asyncio.get_running_loop()
+    client = http_client or TWILIO_HTTPX
+    endpoint = f"{TWILIO_API}/Accounts/{account_sid}/Messages.json"
+    # Identical for every recipient, so build these once per message.
+    urls = list(media_urls or [])[:1]
+    content_variables = json.dumps({"1": (body or "")[:max_body]})
 
     async def _send(to_num: str):
         logging.info("Sending to %s", to_num)
 
-        def _create(template: bool = False):
-            urls = list(media_urls or [])
-            kwargs = {"from_": wa_from, "to": to_num}
+        async def _create(template: bool = False):
+            form = {"From": wa_from, "To": to_num}
             if template:
                 tpl = img_tpl if urls else text_tpl
                 if not tpl:
                     return None
-                kwargs["content_sid"] = tpl
-                kwargs["content_variables"] = json.dumps({"1": body[:max_body]})
-                if urls:
-                    kwargs["media_url"] = urls[:1]
+                form["ContentSid"] = tpl
+                form["ContentVariables"] = content_variables
             else:
-                kwargs["body"] = body
-                if urls:
-                    kwargs["media_url"] = urls[:1]
-            return twilio_client.messages.create(**kwargs)
+                form["Body"] = body or ""
+            if urls:
+                form["MediaUrl"] = urls
+            resp = await client.post(
+                endpoint, auth=(account_sid, auth_token), data=form
+            )
+            if resp.is_error:
+                raise _twilio_error(resp)
+            return resp.json()
 
         try:
-            await loop.run_in_executor(None, _create)
+            await _create()
             logging.info("Sent to %s", to_num)
-        except exc_cls as e:
+        except TwilioRestException as e:
             logging.exception("Twilio error sending to %s", to_num)
             if getattr(e, "code", None) == 63016 and (text_tpl or img_tpl):
                 try:
-                    await loop.run_in_executor(None, lambda: _create(True))
+                    await _create(True)
                     logging.info("Sent to %s via template", to_num)
-                except exc_cls:
+                except TwilioRestException:
                     logging.exception("Twilio template error sending to %s", to_num)
 
     await asyncio.gather(*(_send(n) for n in wa_targets))